@@ -2,15 +2,21 @@
 """
 
 import datetime
+import hashlib
+import io
 import os
 import sys
 import json
 import logging
-from xml.etree import ElementTree
-import gzip
+import operator
+import re
+import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import toml
 import requests
+import urllib3
+from isal import igzip
 
 from googleapiclient.discovery import build
 from google_auth_oauthlib.flow import InstalledAppFlow
@@ -22,6 +28,13 @@ CONFIG_PATH = 'config.toml'
 SCOPE = ['https://www.googleapis.com/auth/spreadsheets.readonly']
 NATION_DUMP_URL = 'https://www.nationstates.net/archive/nations/{date}-nations-xml.gz'
 NATION_DUMP_NAME = '{date}-nations-xml.gz'
+ISSUE_COUNTS_CACHE_NAME = '{date}-issue-counts-{key}.json'
+DOWNLOAD_CHUNK_SIZE = 128 * 1024
+DUMP_CHUNK_SIZE = 1 << 20
+NATION_END_TAG = b'</NATION>'
+# Only the NAME right at the start of a nation, not the ones nested in e.g. POLICIES.
+NATION_NAME_PATTERN = re.compile(rb'<NATION>\s*<NAME>([^<]*)</NAME>')
+ISSUES_ANSWERED_PATTERN = re.compile(rb'<ISSUES_ANSWERED>(\d+)</ISSUES_ANSWERED>')
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
@@ -93,77 +106,189 @@ def get_puppets_from_sheet(sheet_resource, spreadsheet_id: str, sheet_range: str
     return {canonical_nation_name(row[0]): canonical_nation_name(row[1]) for row in rows}
 
 
-def download_nation_dump(dump_date_str: str, dump_filename: str) -> None:
-    """Download nation data dump of a specified date.
+def get_puppet_issue_counts(dump_file, puppets: dict) -> dict:
+    """Get answered issue counts since founding (ISSUE_ANSWERED tag)
+    of puppets from nation data dump.
+
+    The dump is scanned for nation NAME tags directly instead of being parsed as XML,
+    and ISSUES_ANSWERED is only looked for in nations that are puppets.
 
     Args:
-        dump_date_str (str): Date in ISO format
-        dump_filename (str): Filename to save as
+        dump_file (file-like object or path): Dump file object
+        puppets (dict): Puppets
+
+    Returns:
+        dict: Issue count keyed by puppet name
     """
 
-    url = NATION_DUMP_URL.format(date=dump_date_str)
-    logger.info('Downloading data dump from %s', url)
-    with requests.get(url, stream=True) as res:
-        res.raise_for_status()
-        with open(dump_filename, 'wb') as dump:
-            for chunk in res.iter_content(chunk_size=8192):
-                dump.write(chunk)
+    if isinstance(dump_file, (str, os.PathLike)):
+        with open(dump_file, 'rb') as file_obj:
+            return get_puppet_issue_counts(file_obj, puppets)
 
+    # Match names as raw bytes so that names of other nations are never decoded.
+    puppet_names = {puppet_name.encode(): puppet_name for puppet_name in puppets}
+    puppet_issue_counts = {}
+    tail = b''
+    while True:
+        chunk = dump_file.read(DUMP_CHUNK_SIZE)
+        buffer = tail + chunk
+        # Only scan up to the last complete nation,
+        # the rest is carried over to the next chunk.
+        scan_end = len(buffer)
+        if chunk:
+            last_end_tag = buffer.rfind(NATION_END_TAG)
+            scan_end = last_end_tag + len(NATION_END_TAG) if last_end_tag != -1 else 0
+
+        for name_match in NATION_NAME_PATTERN.finditer(buffer, 0, scan_end):
+            puppet_name = puppet_names.get(name_match.group(1).lower())
+            if puppet_name is None:
+                continue
+            # Other nations are skipped right after their name,
+            # only puppets are searched further for their issue count.
+            nation_end = buffer.find(NATION_END_TAG, name_match.end(), scan_end)
+            issues_match = ISSUES_ANSWERED_PATTERN.search(buffer, name_match.end(),
+                                                          scan_end if nation_end == -1 else nation_end)
+            if issues_match is not None:
+                puppet_issue_counts[puppet_name] = int(issues_match.group(1))
+
+        if not chunk:
+            return puppet_issue_counts
+        tail = buffer[scan_end:]
 
-def download_nation_dump_if_not_exists(dump_date: datetime.date) -> str:
-    """Download nation data dump if not exist and return dump filename.
+
+def get_puppet_issue_counts_from_gzip(filename: str, puppets: dict) -> dict:
+    """Get puppet issue count from data dump file.
 
     Args:
-        dump_date (datetime.date): Date in ISO format
+        filename (str): Data dump file name
+        puppets (dict): Puppets and their owners
 
     Returns:
-        str: Dump filename
+        dict: Issue count keyed by puppet name
     """
 
-    dump_date_str = dump_date.isoformat()
-    dump_filename = NATION_DUMP_NAME.format(date=dump_date_str)
-    if not os.path.exists(dump_filename):
-        download_nation_dump(dump_date_str, dump_filename)
-        logger.info('Downloaded data dump: %s', dump_filename)
-    return dump_filename
+    with igzip.open(filename, 'rb') as dump_file:
+        return get_puppet_issue_counts(dump_file, puppets)
 
 
-def get_puppet_issue_counts(dump_file, puppets: dict) -> dict:
-    """Get answered issue counts since founding (ISSUE_ANSWERED tag)
-    of puppets from nation data dump.
+class TeeReader(io.RawIOBase):
+    """Binary stream that copies everything read from a stream into a file.
+    """
+
+    def __init__(self, stream, file_obj):
+        """
+        Args:
+            stream (file-like object): Stream to read from
+            file_obj (file-like object): File to copy read data into
+        """
+
+        super().__init__()
+        self.stream = stream
+        self.file_obj = file_obj
+
+    def readable(self) -> bool:
+        """Always readable, as reading is all this stream does.
+        """
+
+        return True
+
+    def readinto(self, buffer) -> int:
+        """Read from the stream into buffer and copy the read data into the file.
+        """
+
+        size = self.stream.readinto(buffer)
+        # None means no data is available yet on a non-blocking stream
+        if size:
+            self.file_obj.write(memoryview(buffer)[:size])
+        return size
+
+
+def download_puppet_issue_counts(dump_date_str: str, dump_filename: str, puppets: dict,
+                                 keep_dump: bool = True) -> dict:
+    """Get puppet issue count from nation data dump of a specified date
+    while downloading it, without reading the dump back from disk.
 
     Args:
-        dump_file (file-like object): Dump file object
-        puppets (dict): Puppets
+        dump_date_str (str): Date in ISO format
+        dump_filename (str): Filename to save dump as
+        puppets (dict): Puppets and their owners
+        keep_dump (bool): Save the dump to disk for later runs. Defaults to True.
 
     Returns:
         dict: Issue count keyed by puppet name
     """
 
-    puppet_issue_counts = {}
-    for event, elem in ElementTree.iterparse(dump_file):
-        if event == 'end' and elem.tag == 'NATION':
-            nation_name = canonical_nation_name(elem.find('NAME').text)
-            if nation_name in puppets:
-                issue_count = int(elem.find('ISSUES_ANSWERED').text)
-                puppet_issue_counts[nation_name] = issue_count
-            elem.clear()
+    url = NATION_DUMP_URL.format(date=dump_date_str)
+    logger.info('Downloading data dump from %s', url)
+    # The raw response is read directly, so turn urllib3 errors into
+    # the same requests exceptions that Response.iter_content raises.
+    try:
+        with requests.get(url, stream=True) as res:
+            res.raise_for_status()
+            if not keep_dump:
+                with igzip.open(res.raw, 'rb') as dump_file:
+                    return get_puppet_issue_counts(dump_file, puppets)
+
+            # Download to a temporary file first so that an interrupted download
+            # is not taken as a complete dump on the next run.
+            temp_dump_filename = '{}.tmp'.format(dump_filename)
+            dump = open(temp_dump_filename, 'wb')
+            try:
+                with dump:
+                    with igzip.open(TeeReader(res.raw, dump), 'rb') as dump_file:
+                        puppet_issue_counts = get_puppet_issue_counts(dump_file, puppets)
+                    # Save anything left after the end of gzip stream as well
+                    shutil.copyfileobj(res.raw, dump, DOWNLOAD_CHUNK_SIZE)
+            except BaseException:
+                os.remove(temp_dump_filename)
+                raise
+    except urllib3.exceptions.ProtocolError as err:
+        raise requests.exceptions.ChunkedEncodingError(err) from err
+    except urllib3.exceptions.SSLError as err:
+        raise requests.exceptions.SSLError(err) from err
+    except urllib3.exceptions.ReadTimeoutError as err:
+        raise requests.ConnectionError(err) from err
+    os.replace(temp_dump_filename, dump_filename)
+    logger.info('Downloaded data dump: %s', dump_filename)
     return puppet_issue_counts
 
 
-def get_puppet_issue_counts_from_gzip(filename: str, puppets: dict) -> dict:
-    """Get puppet issue count from data dump file.
+def get_puppet_issue_counts_on_date(dump_date: datetime.date, puppets: dict, keep_dump: bool = True) -> dict:
+    """Get puppet issue count on a date from the downloaded data dump if exists,
+    otherwise download it. Results are cached per date and set of puppets.
 
     Args:
-        filename (str): Data dump file name
+        dump_date (datetime.date): Date of data dump
         puppets (dict): Puppets and their owners
+        keep_dump (bool): Save the dump to disk if downloaded. Defaults to True.
 
     Returns:
         dict: Issue count keyed by puppet name
     """
 
-    dump_file = gzip.open(filename)
-    return get_puppet_issue_counts(dump_file, puppets)
+    dump_date_str = dump_date.isoformat()
+    cache_key = hashlib.sha1(json.dumps(sorted(puppets)).encode()).hexdigest()[:16]
+    cache_filename = ISSUE_COUNTS_CACHE_NAME.format(date=dump_date_str, key=cache_key)
+    if os.path.exists(cache_filename):
+        try:
+            with open(cache_filename) as cache:
+                return json.load(cache)
+        except json.JSONDecodeError:
+            logger.warning('Ignoring corrupted issue count cache: %s', cache_filename)
+
+    dump_filename = NATION_DUMP_NAME.format(date=dump_date_str)
+    if os.path.exists(dump_filename):
+        puppet_issue_counts = get_puppet_issue_counts_from_gzip(dump_filename, puppets)
+    else:
+        puppet_issue_counts = download_puppet_issue_counts(dump_date_str, dump_filename, puppets, keep_dump)
+
+    # Write to a temporary file first so that an interrupted write
+    # is not taken as a complete cache on the next run.
+    temp_cache_filename = '{}.tmp'.format(cache_filename)
+    with open(temp_cache_filename, 'w') as cache:
+        json.dump(puppet_issue_counts, cache)
+    os.replace(temp_cache_filename, cache_filename)
+    return puppet_issue_counts
 
 
 def get_leaderboard(puppets: dict, start_date_issue_counts: dict, end_date_issue_counts: dict) -> dict:
@@ -178,22 +303,14 @@ def get_leaderboard(puppets: dict, start_date_issue_counts: dict, end_date_issue
         dict: Issue leaderboard
     """
 
-    leaderboard = {}
+    leaderboard = dict.fromkeys(puppets.values(), 0)
     for puppet_name, owner_name in puppets.items():
-        if owner_name not in leaderboard:
-            leaderboard[owner_name] = 0
-
-        if puppet_name not in end_date_issue_counts:
+        end_date_count = end_date_issue_counts.get(puppet_name)
+        if end_date_count is None:
             continue
-        end_date_count = end_date_issue_counts[puppet_name]
+        leaderboard[owner_name] += end_date_count - start_date_issue_counts.get(puppet_name, 0)
 
-        if puppet_name not in start_date_issue_counts:
-            leaderboard[owner_name] += end_date_count
-        else:
-            start_date_count = start_date_issue_counts[puppet_name]
-            leaderboard[owner_name] += end_date_count - start_date_count
-
-    return dict(sorted(leaderboard.items(), key=lambda item: item[1], reverse=True))
+    return dict(sorted(leaderboard.items(), key=operator.itemgetter(1), reverse=True))
 
 
 def export_to_json(issue_leaderboard: dict, file_path: str, org_name: str = None, key_name: str = None) -> None:
@@ -235,18 +352,6 @@ def main():
         logger.error("Date is not in ISO format")
         exit(1)
 
-    try:
-        start_date_dump_name = download_nation_dump_if_not_exists(start_date)
-        logger.info('Got data dump on start date: %s', start_date)
-        end_date_dump_name = download_nation_dump_if_not_exists(end_date)
-        logger.info('Got data dump on end date: %s', end_date)
-    except requests.HTTPError as err:
-        logger.error('Failed to download nation data dump. HTTP error: %s', err.response.status_code)
-        exit(1)
-    except requests.ConnectionError as err:
-        logger.error('Failed to download nation data dump. Network error')
-        exit(1)
-
     sheet_config = config['puppet_spreadsheet']
     try:
         sheet_service = get_sheet_service(sheet_config['oauth_cred_path'])
@@ -260,8 +365,30 @@ def main():
         exit(1)
     logger.info('Fetched puppet data from spreadsheet')
 
-    start_date_issue_counts = get_puppet_issue_counts_from_gzip(start_date_dump_name, puppets)
-    end_date_issue_counts = get_puppet_issue_counts_from_gzip(end_date_dump_name, puppets)
+    keep_dump = not general_config.get('delete_dump_file_after_done', False)
+    # Dumps of different dates are independent, so download and scan them in parallel.
+    dump_dates = sorted({start_date, end_date})
+    issue_counts = {}
+    with ProcessPoolExecutor(max_workers=len(dump_dates)) as executor:
+        futures = {executor.submit(get_puppet_issue_counts_on_date, dump_date, puppets, keep_dump): dump_date
+                   for dump_date in dump_dates}
+        # Log whichever date fails first right away. Exiting still waits for the
+        # other worker to finish, as a running task cannot be cancelled.
+        try:
+            for future in as_completed(futures):
+                issue_counts[futures[future]] = future.result()
+                logger.info('Got issue counts on date: %s', futures[future])
+        except requests.HTTPError as err:
+            logger.error('Failed to download nation data dump. HTTP error: %s', err.response.status_code)
+            exit(1)
+        except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError):
+            logger.error('Failed to download nation data dump. Network error')
+            exit(1)
+        except EOFError:
+            logger.error('Nation data dump is incomplete')
+            exit(1)
+    start_date_issue_counts = issue_counts[start_date]
+    end_date_issue_counts = issue_counts[end_date]
 
     leaderboard = get_leaderboard(puppets, start_date_issue_counts, end_date_issue_counts)
     logger.info('Finished counting issues')
@@ -270,9 +397,11 @@ def main():
     export_to_json(leaderboard, export_config['json_path'], export_config['org_name'], export_config['key_name'])
     logger.info('Exported to JSON file at %s', export_config['json_path'])
 
-    if general_config.get('delete_dump_file_after_done', False):
-        os.remove(start_date_dump_name)
-        os.remove(end_date_dump_name)
+    if not keep_dump:
+        for dump_date in (start_date, end_date):
+            dump_filename = NATION_DUMP_NAME.format(date=dump_date.isoformat())
+            if os.path.exists(dump_filename):
+                os.remove(dump_filename)
         logger.info('Deleted dump files')
 
 
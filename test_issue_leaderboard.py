@@ -1,5 +1,13 @@
+import datetime
+import gzip
+import io
+import json
 from unittest import mock
 
+import pytest
+import requests
+import urllib3
+
 import issue_leaderboard
 
 
@@ -122,3 +130,199 @@ class TestGetPuppetIssueCounts:
         result = issue_leaderboard.get_puppet_issue_counts(xml_path, puppets)
 
         assert result == {'puppet 1': 1, 'puppet 2': 2, 'puppet 3': 3}
+
+    def test_skips_other_tags_of_a_nation(self, tmp_path):
+        xml = """<NATIONS><NATION>
+                 <NAME>Puppet 1</NAME>
+                 <TYPE>Republic</TYPE>
+                 <FREEDOM><CIVILRIGHTS>Good</CIVILRIGHTS></FREEDOM>
+                 <FLAG/>
+                 <ISSUES_ANSWERED>5</ISSUES_ANSWERED>
+                 <POPULATION>100</POPULATION>
+                 </NATION></NATIONS>"""
+        xml_path = tmp_path / 'xml_test.xml'
+        xml_path.write_text(xml)
+        puppets = {'puppet 1': 'owner 1'}
+
+        result = issue_leaderboard.get_puppet_issue_counts(xml_path, puppets)
+
+        assert result == {'puppet 1': 5}
+
+    def test_counts_issues_of_nations_spanning_many_chunks(self, tmp_path, monkeypatch):
+        xml = """<NATIONS><NATION>
+                 <NAME>Puppet 1</NAME>
+                 <ISSUES_ANSWERED>1</ISSUES_ANSWERED>
+                 </NATION>
+                 <NATION>
+                 <NAME>Puppet 2</NAME>
+                 <ISSUES_ANSWERED>2</ISSUES_ANSWERED>
+                 </NATION></NATIONS>"""
+        xml_path = tmp_path / 'xml_test.xml'
+        xml_path.write_text(xml)
+        puppets = {'puppet 1': 'owner 1', 'puppet 2': 'owner 2'}
+        monkeypatch.setattr(issue_leaderboard, 'DUMP_CHUNK_SIZE', 7)
+
+        result = issue_leaderboard.get_puppet_issue_counts(xml_path, puppets)
+
+        assert result == {'puppet 1': 1, 'puppet 2': 2}
+
+    def test_does_not_take_issue_count_of_next_nation(self, tmp_path):
+        xml = """<NATIONS><NATION>
+                 <NAME>Puppet 1</NAME>
+                 </NATION>
+                 <NATION>
+                 <NAME>Puppet 2</NAME>
+                 <ISSUES_ANSWERED>2</ISSUES_ANSWERED>
+                 </NATION></NATIONS>"""
+        xml_path = tmp_path / 'xml_test.xml'
+        xml_path.write_text(xml)
+        puppets = {'puppet 1': 'owner 1'}
+
+        result = issue_leaderboard.get_puppet_issue_counts(xml_path, puppets)
+
+        assert result == {}
+
+    def test_skips_nested_names_of_other_nations(self, tmp_path):
+        xml = """<NATIONS><NATION>
+                 <NAME>Socialism</NAME>
+                 <ISSUES_ANSWERED>7</ISSUES_ANSWERED>
+                 </NATION>
+                 <NATION>
+                 <NAME>Other</NAME>
+                 <POLICIES><POLICY><NAME>Socialism</NAME></POLICY></POLICIES>
+                 <ISSUES_ANSWERED>999</ISSUES_ANSWERED>
+                 </NATION></NATIONS>"""
+        xml_path = tmp_path / 'xml_test.xml'
+        xml_path.write_text(xml)
+        puppets = {'socialism': 'owner 1'}
+
+        result = issue_leaderboard.get_puppet_issue_counts(xml_path, puppets)
+
+        assert result == {'socialism': 7}
+
+
+class TestTeeReader:
+    def test_copies_read_data_into_file(self):
+        copy = io.BytesIO()
+        tee = issue_leaderboard.TeeReader(io.BytesIO(b'data'), copy)
+
+        result = tee.read()
+
+        assert result == b'data'
+        assert copy.getvalue() == b'data'
+
+    def test_copies_nothing_if_no_data_is_available(self):
+        copy = io.BytesIO()
+        tee = issue_leaderboard.TeeReader(mock.Mock(readinto=mock.Mock(return_value=None)), copy)
+
+        result = tee.readinto(bytearray(4))
+
+        assert result is None
+        assert copy.getvalue() == b''
+
+
+class TestDownloadPuppetIssueCounts:
+    xml = b"""<NATIONS><NATION>
+              <NAME>Puppet 1</NAME>
+              <ISSUES_ANSWERED>5</ISSUES_ANSWERED>
+              </NATION></NATIONS>"""
+
+    def mock_get(self):
+        res = mock.Mock(raw=io.BytesIO(gzip.compress(self.xml)))
+        return mock.MagicMock(**{'return_value.__enter__.return_value': res})
+
+    def test_counts_issues_and_saves_dump(self, tmp_path):
+        dump_path = tmp_path / 'dump.xml.gz'
+        puppets = {'puppet 1': 'owner 1'}
+
+        with mock.patch('requests.get', self.mock_get()):
+            result = issue_leaderboard.download_puppet_issue_counts('2021-10-01', dump_path, puppets)
+
+        assert result == {'puppet 1': 5}
+        assert gzip.decompress(dump_path.read_bytes()) == self.xml
+
+    def test_does_not_save_dump_if_not_kept(self, tmp_path):
+        dump_path = tmp_path / 'dump.xml.gz'
+        puppets = {'puppet 1': 'owner 1'}
+
+        with mock.patch('requests.get', self.mock_get()):
+            result = issue_leaderboard.download_puppet_issue_counts('2021-10-01', dump_path, puppets,
+                                                                    keep_dump=False)
+
+        assert result == {'puppet 1': 5}
+        assert not dump_path.exists()
+
+    def test_does_not_save_dump_if_download_fails(self, tmp_path):
+        dump_path = tmp_path / 'dump.xml.gz'
+        puppets = {'puppet 1': 'owner 1'}
+        get = self.mock_get()
+        get.return_value.__enter__.return_value.raw = io.BytesIO(gzip.compress(self.xml)[:20])
+
+        with mock.patch('requests.get', get):
+            with pytest.raises(EOFError):
+                issue_leaderboard.download_puppet_issue_counts('2021-10-01', dump_path, puppets)
+
+        assert not dump_path.exists()
+        assert not (tmp_path / 'dump.xml.gz.tmp').exists()
+
+    def test_raises_error_if_dump_cannot_be_written(self, tmp_path):
+        dump_path = tmp_path / 'dump.xml.gz'
+        puppets = {'puppet 1': 'owner 1'}
+
+        with mock.patch('requests.get', self.mock_get()):
+            with mock.patch('issue_leaderboard.open', create=True, side_effect=PermissionError):
+                with pytest.raises(PermissionError):
+                    issue_leaderboard.download_puppet_issue_counts('2021-10-01', dump_path, puppets)
+
+    def test_raises_requests_error_if_connection_breaks(self, tmp_path):
+        dump_path = tmp_path / 'dump.xml.gz'
+        puppets = {'puppet 1': 'owner 1'}
+        get = self.mock_get()
+        raw = mock.Mock(readinto=mock.Mock(side_effect=urllib3.exceptions.ProtocolError('Connection broken')))
+        get.return_value.__enter__.return_value.raw = raw
+
+        with mock.patch('requests.get', get):
+            with pytest.raises(requests.exceptions.ChunkedEncodingError):
+                issue_leaderboard.download_puppet_issue_counts('2021-10-01', dump_path, puppets)
+
+
+class TestGetPuppetIssueCountsOnDate:
+    def test_caches_issue_counts(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        dump_date = datetime.date(2021, 10, 1)
+        puppets = {'puppet 1': 'owner 1'}
+        get_counts = mock.Mock(return_value={'puppet 1': 5})
+
+        with mock.patch('issue_leaderboard.download_puppet_issue_counts', get_counts):
+            issue_leaderboard.get_puppet_issue_counts_on_date(dump_date, puppets)
+            result = issue_leaderboard.get_puppet_issue_counts_on_date(dump_date, puppets)
+
+        assert result == {'puppet 1': 5}
+        get_counts.assert_called_once()
+
+    def test_does_not_use_cache_of_other_puppets(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        dump_date = datetime.date(2021, 10, 1)
+        get_counts = mock.Mock(return_value={})
+
+        with mock.patch('issue_leaderboard.download_puppet_issue_counts', get_counts):
+            issue_leaderboard.get_puppet_issue_counts_on_date(dump_date, {'puppet 1': 'owner 1'})
+            issue_leaderboard.get_puppet_issue_counts_on_date(dump_date, {'puppet 2': 'owner 1'})
+
+        assert get_counts.call_count == 2
+
+    def test_ignores_corrupted_cache(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        dump_date = datetime.date(2021, 10, 1)
+        puppets = {'puppet 1': 'owner 1'}
+        get_counts = mock.Mock(return_value={'puppet 1': 5})
+
+        with mock.patch('issue_leaderboard.download_puppet_issue_counts', get_counts):
+            issue_leaderboard.get_puppet_issue_counts_on_date(dump_date, puppets)
+            cache_path, = tmp_path.glob('*-issue-counts-*.json')
+            cache_path.write_text('{"puppet 1": ')
+            result = issue_leaderboard.get_puppet_issue_counts_on_date(dump_date, puppets)
+
+        assert result == {'puppet 1': 5}
+        assert get_counts.call_count == 2
+        assert json.loads(cache_path.read_text()) == {'puppet 1': 5}